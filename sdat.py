@@ -4,131 +4,534 @@ find basic owner and transfer information.  Use CLI to provide arguments for the
 """
 
 import argparse
-from urllib.parse import urlencode
+import asyncio
+import email.message
+import functools
+import hashlib
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+import aiohttp
 import requests
-from bs4 import BeautifulSoup, element as bs4_element
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+BASE_URL = "https://sdat.dat.maryland.gov/RealProperty/Pages/viewdetails.aspx"
+# per-parcel part of the query string; zero-padded numbers never need URL quoting
+PARCEL_QUERY_TEMPLATE = (
+    "&ward={ward:02d}&section={section:02d}&block={block:04d}&lot={lot:03d}"
+)
+# (connect, read) timeouts in seconds for requests to SDAT
+REQUEST_TIMEOUT = (3.05, 15)
+# number of bytes fed to the HTML parser at a time while looking for the detail table
+PARSE_CHUNK_SIZE = 16 * 1024
+
+# non-ASCII whitespace (e.g. &nbsp;) that str.split() treats as a separator,
+# but XPath's normalize-space() does not
+UNICODE_SPACES = (
+    '\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a'
+    '\u2028\u2029\u202f\u205f\u3000'
+)
+# selects the row of the <th> whose whitespace-collapsed text equals the given header
+HEADER_ROW_XPATH = (
+    ".//th[normalize-space(translate(., '" + UNICODE_SPACES + "', '"
+    + ' ' * len(UNICODE_SPACES) + "'))='{}']"
+    "/ancestor::tr[1]"
+)
+# the two rows after the "Owner Information" header hold the owner name(s) and
+# mailing address
+OWNER_INFO_XPATH = etree.XPath(HEADER_ROW_XPATH.format('Owner Information'))
+# the row after the "Transfer Information" header wraps an inner table with the
+# transfer details
+TRANSFER_INFO_XPATH = etree.XPath(HEADER_ROW_XPATH.format('Transfer Information'))
+# cells of a table row
+ROW_CELLS_XPATH = etree.XPath('./td')
+# labels of the transfer detail cells that are kept
+TRANSFER_INFO_HEADERS = frozenset(
+    ('Seller:', 'Date:', 'Price:', 'Type:', 'Deed1:', 'Deed2:')
+)
+
+
+_thread_local = threading.local()
+
+
+def get_parser(encoding=None):
+    """
+    Return the calling thread's HTML parser for an encoding, creating it on first use.
+    lxml parsers must not be shared between threads, but can be reused page after page.
+    The parser only reports the end of each table, and skips building the id lookup,
+    comments and whitespace-only text that the scraper never reads.
+    :param encoding: charset from the Content-Type header, or None to sniff the page
+    :return: lxml.etree.HTMLPullParser
+    """
+    parsers = getattr(_thread_local, 'parsers', None)
+    if parsers is None:
+        parsers = _thread_local.parsers = dict()
+
+    parser = parsers.get(encoding)
+    if parser is None:
+        try:
+            parser = etree.HTMLPullParser(
+                events=('end',),
+                tag='table',
+                encoding=encoding,
+                collect_ids=False,
+                remove_blank_text=True,
+                remove_comments=True,
+            )
+        except LookupError:
+            # libxml2 does not know the declared encoding; detect it from the page
+            parser = get_parser()
+        parsers[encoding] = parser
+    return parser
+
+
+def header_charset(content_type):
+    """
+    Return the charset declared in a Content-Type header.
+    :param content_type: Content-Type header value, or None
+    :return: str, or None if the header does not declare a charset
+    """
+    if not content_type:
+        return None
+    message = email.message.Message()
+    message['Content-Type'] = content_type
+    return message.get_content_charset()
+
+
+def session_factory():
+    """
+    Create a requests session that keeps connections to SDAT alive between requests.
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount('https://', adapter)
+    # Accept-Encoding is left to requests, which adds br to gzip and deflate when Brotli
+    # (see requirements.txt) is installed
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def url_prefix(search_type, county):
+    """
+    Return the property URL prefix shared by every parcel of a search type and county.
+    :return: base URL with the search_type and county query parameters
+    """
+    query = urlencode({'search_type': search_type, 'county': f'{county:02d}'})
+    return f"{BASE_URL}?{query}"
+
+
+def build_property_url(search_type, county, ward, section, block, lot):
+    """
+    Build the SDAT property URL for a parcel.
+    :return: str
+    """
+    return url_prefix(search_type, county) + PARCEL_QUERY_TEMPLATE.format(
+        ward=ward, section=section, block=block, lot=lot
+    )
+
+
+def canonical_url(property_url):
+    """
+    Normalize a property URL so that equivalent queries share a cache entry.
+    :param property_url: SDAT property URL
+    :return: URL with a lower-case host and sorted query parameters
+    """
+    scheme, netloc, path, query, _ = urlsplit(property_url)
+    query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme.lower(), netloc.lower(), path, query, ''))
+
+
+def rows_after_anchor(table, anchor_xpath, count):
+    """
+    Return the rows that follow a header row, stopping after `count` rows.
+    :param table: lxml Table element
+    :param anchor_xpath: compiled XPath selecting the header row
+    :param count: maximum number of rows to return
+    :return: list of lxml TableRow elements
+    """
+    anchors = anchor_xpath(table)
+    if not anchors:
+        return []
+    return list(islice(anchors[0].itersiblings('tr'), count))
+
+
+def text_parts(element):
+    """
+    Return the stripped, non-empty text nodes of an element, e.g. the lines of an
+    address split by <br>.
+    :param element: lxml element
+    :return: list of str
+    """
+    return [text for text in map(str.strip, element.itertext()) if text]
+
+
+def match_table(events, table_id):
+    """
+    Return the first table with the given id among parser events.
+    :param events: (event, element) pairs from an lxml pull parser
+    :return: lxml element representing an HTML table, or None
+    """
+    # tables nested inside the one we want end first, so they must not be cleared
+    for _, table in events:
+        if table.get('id') == table_id:
+            return table
+
+
+def find_table(html, table_id, encoding=None):
+    """
+    Parses page up to the end of the HTML table with the given id and returns it.
+    The rest of the page is never parsed.  A page truncated inside the table still
+    returns it, with whatever content arrived.
+    :param html: page content as bytes
+    :param encoding: charset from the Content-Type header, or None to sniff the page
+    :return: lxml element representing an HTML table, or None
+    """
+    if not html:
+        # the parser refuses to close on a document it has not been fed
+        return None
+
+    parser = get_parser(encoding)
+    table = None
+    try:
+        for start in range(0, len(html), PARSE_CHUNK_SIZE):
+            parser.feed(html[start:start + PARSE_CHUNK_SIZE])
+            table = match_table(parser.read_events(), table_id)
+            if table is not None:
+                break
+    finally:
+        # finish this page so the parser can be reused; this also ends tables left
+        # open by a truncated page
+        parser.close()
+        events = parser.read_events()
+        if table is None:
+            table = match_table(events, table_id)
+        # drop events that were not handed out
+        for _ in events:
+            pass
+    return table
+
+
+def find_owner_rows(table):
+    """
+    Return the two rows following the "Owner Information" header.
+    :param table: lxml Table element
+    :return: list of two lxml TableRow elements
+    """
+    return rows_after_anchor(table, OWNER_INFO_XPATH, 2)
+
+
+def find_transfer_table(table):
+    """
+    Return the inner table following the "Transfer Information" header.
+    :param table: lxml Table element
+    :return: an lxml Table element, or None
+    """
+    for row in rows_after_anchor(table, TRANSFER_INFO_XPATH, 1):
+        td = next(row.iter('td'), None)
+        if td is not None:
+            return next(td.iter('table'), None)
+
+
+def parse_owner_info(table):
+    """
+    Return the owner name(s) and mailing address from the detail table.
+    :param table: lxml Table element
+    :return: tuple of str
+    :raises ValueError: if the owner information header or its rows are missing
+    """
+    rows = find_owner_rows(table)
+    if not rows:
+        raise ValueError("owner information rows not found")
+
+    mailing_address = list()
+
+    for row in rows:
+        tds = ROW_CELLS_XPATH(row)
+        if len(tds) < 2:
+            raise ValueError("owner information rows not found")
+        mailing_address.extend(text_parts(tds[1]))
+
+    return tuple(mailing_address)
+
+
+def parse_transfer_info(table):
+    """
+    Return the transfer details from the detail table.
+    :param table: lxml Table element
+    :return: tuple of (label, value, ...) tuples
+    :raises ValueError: if the detail table has no transfer table
+    """
+    inner_table = find_transfer_table(table)
+    if inner_table is None:
+        raise ValueError("transfer information table not found")
+
+    transfer_info = list()
+
+    for tr in inner_table.iter('tr'):
+        for td in ROW_CELLS_XPATH(tr):
+            parts = text_parts(td)
+            if len(parts) > 1 and parts[0] in TRANSFER_INFO_HEADERS:
+                transfer_info.append(tuple(parts))
+
+    return tuple(transfer_info)
+
+
+def page_digest(html):
+    """
+    Return a short digest of a page's content, used to recognize pages already parsed.
+    :param html: page content as bytes
+    :return: bytes
+    """
+    return hashlib.blake2b(html, digest_size=16).digest()
+
+
+def parse_detail(html, encoding=None):
+    """
+    Parse a page from SDAT and return its owner and transfer information.
+    Depends only on the page content, and returns immutable tuples so the result
+    can be shared.
+    :param html: page content as bytes
+    :param encoding: charset from the Content-Type header, or None to sniff the page
+    :return: tuple of owner information and transfer information
+    :raises ValueError: if the page has no detail table, owner rows or transfer table
+    """
+    detail_search_table = find_table(html, table_id='detailSearch', encoding=encoding)
+    if detail_search_table is None:
+        raise ValueError("detailSearch table not found")
+    owner_info = parse_owner_info(detail_search_table)
+    transfer_info = parse_transfer_info(detail_search_table)
+    return owner_info, transfer_info
 
 
 class ScrapeSDAT:
     """Scrape SDAT site to find basic owner and transfer information."""
 
-    def parse_html(self, table):
+    # shared by all instances so that batches of lookups reuse pooled connections
+    _session = session_factory()
+
+    def __init__(self, cache_size=1024, max_age=3600):
         """
-        Parse HTML table content.
-        :param table: BeautifulSoup4 table object
-        :return: None
+        :param cache_size: maximum number of pages and URLs whose results are kept
+        :param max_age: seconds before a cached URL is fetched again; None never expires
         """
-        # parse table rows
-        tbody = table.find('tbody')
-        trs = tbody.find_all('tr', class_=['tr_blanc', 'tr_bleu1'])
-        band_set = None
-        bandwidths = None
-        total = len(trs)
+        self.cache_size = cache_size
+        self.max_age = max_age
+        self._url_cache = OrderedDict()
+        self._parse_cache = OrderedDict()
+        # guards both caches; scrape() may be called from several threads
+        self._cache_lock = threading.Lock()
 
-        with tqdm(total=total) as pbar:
-            for tr_no, tr in enumerate(trs):
-                band_set, bandwidths = self._parse_table_row(tr, band_set, bandwidths)
-                pbar.update(1)
+    @staticmethod
+    def get_table_data(html, table_id, encoding=None):
+        """
+        Parses page up to the end of the HTML table with the given id and returns it.
+        :param html: page content as bytes
+        :param encoding: charset from the Content-Type header, or None to sniff the page
+        :return: lxml element representing an HTML table, or None
+        """
+        return find_table(html, table_id, encoding)
 
     @staticmethod
-    def get_table_data(soup, table_id):
+    def get_owner_info(table):
         """
-        Parses page and returns HTML tables on the page.
-        :return: list of beautifulsoup4 objects, each representing an HTML table
+        Parse a page from SDAT and return the owner name(s) and mailing address.
+        :param table: lxml Table element
+        :return: list
         """
-        return soup.find('table', id=table_id)
+        return list(parse_owner_info(table))
 
     @staticmethod
-    def _parse_owner_info(table):
+    def get_transfer_info(table):
         """
-        Parse a page from SDAT and return two beautifulsoup4 TableRow objects.
-        :param table: beautifulsoup4 Table object
-        :return: list of two beautifulsoup4 TableRow objects
+        Parse a page from SDAT and return the transfer details.
+        :param table: lxml Table element
+        :return: list
         """
-        owner_info_found = False
-        rows = table.find_all('tr')
+        return [list(transfer) for transfer in parse_transfer_info(table)]
 
-        for row_number, row in enumerate(rows):
-            if owner_info_found:
-                return rows[row_number: row_number + 2]
+    def _lookup_parsed(self, html, encoding):
+        """
+        Look up the cached result for a page with the same content and encoding.
+        Pages are keyed on a digest of their content, so the cache does not hold on to
+        the HTML itself.
+        :param html: page content as bytes
+        :param encoding: encoding declared by the HTTP response, or None
+        :return: cache key to pass to _set_parsed, and the cached result or None
+        """
+        key = (page_digest(html), encoding)
+        with self._cache_lock:
+            result = self._parse_cache.get(key)
+            if result is not None:
+                self._parse_cache.move_to_end(key)
+            return key, result
+
+    def _set_parsed(self, key, result):
+        """
+        Remember the result parsed from a page.
+        The least recently used page is evicted when the cache is full.
+        """
+        with self._cache_lock:
+            self._parse_cache[key] = result
+            if len(self._parse_cache) > self.cache_size:
+                self._parse_cache.popitem(last=False)
 
-            for td in row.find_all('th'):
-                text = ' '.join(td.get_text().split())
-                if text == 'Owner Information':
-                    owner_info_found = True
+    def _parse_detail(self, html, encoding=None):
+        """
+        Same as parse_detail, but reuses the result for a page that was already parsed.
+        :param html: page content as bytes
+        :param encoding: charset from the Content-Type header, or None to sniff the page
+        :return: tuple of owner information and transfer information
+        """
+        key, result = self._lookup_parsed(html, encoding)
+        if result is None:
+            result = parse_detail(html, encoding)
+            self._set_parsed(key, result)
+        return result
 
-    @staticmethod
-    def _parse_transfer_info(table):
+    def _get_cached(self, property_url):
         """
-        Parse a page from SDAT and return a beautifulsoup4 Table object.
-        :param table: beautifulsoup4 Table object
-        :return: a beautifulsoup4 Table object
+        Return the result previously scraped for a URL, unless it is older than max_age.
+        Entries older than max_age are dropped.
+        :return: tuple of owner information and transfer information, or None
         """
-        transfer_info_found = False
-        rows = table.find_all('tr')
+        key = canonical_url(property_url)
+        with self._cache_lock:
+            entry = self._url_cache.get(key)
+            if entry is None:
+                return None
 
-        for row in rows:
-            if transfer_info_found:
-                td = row.find('td')
-                return td.find('table')
+            scraped_at, result = entry
+            age = time.monotonic() - scraped_at
+            if self.max_age is not None and age > self.max_age:
+                del self._url_cache[key]
+                return None
 
-            for td in row.find_all('th'):
-                text = ' '.join(td.get_text().split())
-                if text == 'Transfer Information':
-                    transfer_info_found = True
+            self._url_cache.move_to_end(key)
+            return result
 
-    def get_owner_info(self, table):
+    def _set_cached(self, property_url, result):
         """
-        Parse a page from SDAT and return two beautifulsoup4 TableRow objects.
-        :param table: beautifulsoup4 Table object
-        :return: list
+        Remember the result scraped for a URL.
+        The least recently used URL is evicted when the cache is full.
         """
-        separator = "<br/>"
-        two_rows = self._parse_owner_info(table)
-        mailing_address = list()
+        key = canonical_url(property_url)
+        with self._cache_lock:
+            self._url_cache[key] = (time.monotonic(), result)
+            self._url_cache.move_to_end(key)
+            if len(self._url_cache) > self.cache_size:
+                self._url_cache.popitem(last=False)
 
-        for row in two_rows:
-            tds = row.find_all('td')
-            td_text = tds[1].get_text(strip=True, separator=separator)
-            for part in td_text.split(separator):
-                mailing_address.append(part)
-
-        return mailing_address
+    def _fetch_html(self, property_url):
+        """
+        Fetch a page from SDAT.
+        :return: page content as bytes, and the charset declared by the response or None
+        """
+        with self._session.get(
+            property_url, timeout=REQUEST_TIMEOUT, stream=True
+        ) as response:
+            response.raise_for_status()
+            # read the (decompressed) body straight from the socket; closing the
+            # response returns the connection to the pool
+            encoding = header_charset(response.headers.get('Content-Type'))
+            return response.raw.read(decode_content=True), encoding
 
-    def get_transfer_info(self, table):
+    def scrape(self, property_url):
         """
-        Parse a page from SDAT and return two beautifulsoup4 TableRow objects.
-        :param table: beautifulsoup4 Table object
-        :return: list
+        Parses page and prints its owner and transfer information.
+        :return: tuple of owner information and transfer information
         """
-        separator = "<br/>"
-        valid_headers = ('Seller:', 'Date:', 'Price:', 'Type:', 'Deed1:', 'Deed2:')
-        inner_table = self._parse_transfer_info(table)
-        transfer_info = list()
+        result = self._get_cached(property_url)
+        if result is None:
+            result = self._parse_detail(*self._fetch_html(property_url))
+            self._set_cached(property_url, result)
 
-        for tr in inner_table.find_all('tr'):
-            for td in tr.find_all('td'):
-                text = td.get_text(strip=True, separator=separator)
-                if text:
-                    parsed_text = text.split(separator)
-                    if len(parsed_text) > 1 and parsed_text[0] in valid_headers:
-                        transfer_info.append(parsed_text)
+        owner_info, transfer_info = result
+        print(list(owner_info))
+        print([list(transfer) for transfer in transfer_info])
+        return owner_info, transfer_info
 
-        return transfer_info
+    @staticmethod
+    async def _fetch(session, semaphore, property_url):
+        """
+        Fetch a page from SDAT once a slot in the semaphore is free.
+        :return: page content as bytes, and the charset declared by the response or None
+        """
+        async with semaphore, session.get(property_url) as response:
+            response.raise_for_status()
+            return await response.read(), response.charset
 
-    def scrape(self, property_url):
+    async def _fetch_and_parse(self, session, semaphore, executor, property_url):
         """
-        Parses page and returns HTML tables on the page.
-        :return: list of beautifulsoup4 objects, each representing an HTML table
+        Fetch a page from SDAT and parse it in a worker process, so the event loop keeps
+        fetching.
+        :return: tuple of owner information and transfer information
         """
-        page = requests.get(property_url)
-        soup = BeautifulSoup(page.text, 'lxml')
-        detail_search_table = self.get_table_data(soup, table_id='detailSearch')
-        owner_info = self.get_owner_info(detail_search_table)
-        print(owner_info)
-        transfer_info = self.get_transfer_info(detail_search_table)
-        print(transfer_info)
+        result = self._get_cached(property_url)
+        if result is None:
+            html, encoding = await self._fetch(session, semaphore, property_url)
+            key, result = self._lookup_parsed(html, encoding)
+            if result is None:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(
+                    executor, parse_detail, html, encoding
+                )
+                self._set_parsed(key, result)
+            self._set_cached(property_url, result)
+        return result
+
+    async def scrape_many(
+        self, property_urls, concurrency=16, workers=None, executor=None
+    ):
+        """
+        Fetch and parse many pages concurrently, with at most `concurrency` requests
+        in flight.
+        Pages are parsed across a pool of worker processes as they arrive, so parsing
+        overlaps fetching.
+        A URL that fails does not stop the others: its place in the result holds the
+        exception instead, e.g. aiohttp.ClientResponseError for an error status or
+        ValueError for a page without a detail table.
+        :param property_urls: iterable of SDAT property URLs
+        :param concurrency: maximum number of simultaneous requests to SDAT
+        :param workers: number of parsing processes, defaults to the number of CPUs
+        :param executor: caller-owned executor to parse pages in; it is left running
+        :return: list of (owner information, transfer information) tuples or exceptions,
+                 in URL order
+        """
+        semaphore = asyncio.BoundedSemaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1]
+        )
+
+        owns_executor = executor is None
+        if owns_executor:
+            # this process already runs threads (DNS resolver, executors, callers of
+            # scrape()), so workers are started fresh instead of forked from it
+            executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        try:
+            # aiohttp's default Accept-Encoding only lists what aiohttp itself can
+            # decode, including br when Brotli is installed
+            async with aiohttp.ClientSession(
+                connector=connector, timeout=timeout
+            ) as session:
+                return await asyncio.gather(*(
+                    self._fetch_and_parse(session, semaphore, executor, property_url)
+                    for property_url in property_urls
+                ), return_exceptions=True)
+        finally:
+            if owns_executor:
+                # waiting for the workers to exit would block the event loop
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, executor.shutdown)
 
 
 def argument_factory():
@@ -146,16 +549,7 @@ def main():
     """Main function."""
     parser = argument_factory()
     args = parser.parse_args()
-    query_parameters = {
-        'search_type': args.search_type,
-        'county': f"{args.county:02}",
-        'ward': f"{args.ward:02}",
-        'section': f"{args.section:02}",
-        'block': f"{args.block:04}",
-        'lot': f"{args.lot:03}",
-    }
-    base_url = "https://sdat.dat.maryland.gov/RealProperty/Pages/viewdetails.aspx"
-    sdat_property_url =  f"{base_url}?{urlencode(query_parameters)}"
+    sdat_property_url = build_property_url(**vars(args))
     scraper = ScrapeSDAT()
     scraper.scrape(sdat_property_url)
 
@@ -0,0 +1,204 @@
+import asyncio
+import concurrent.futures
+import http.server
+import pathlib
+import threading
+from urllib.parse import urlencode
+
+import aiohttp
+import pytest
+import requests
+
+import sdat
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures'
+
+OWNER_INFO = ('SMITH JOHN', 'SMITH JANE', '123 MAIN ST', 'BALTIMORE MD 21201-1234')
+TRANSFER_INFO = (
+    ('Seller:', 'DOE A'),
+    ('Date:', '01/02/2003'),
+    ('Price:', '$100,000'),
+    ('Type:', 'ARMS LENGTH'),
+    ('Deed1:', '/12345/ 00001'),
+)
+
+
+def read_fixture(name):
+    return (FIXTURES / name).read_bytes()
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """Serve fixture pages by name, and a server error for /error."""
+
+    def do_GET(self):
+        if self.path == '/error':
+            self.send_error(500)
+            return
+        body = read_fixture(self.path.lstrip('/'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('name', ['detail.html', 'detail_nbsp.html'])
+def test_parse_detail(name):
+    assert sdat.parse_detail(read_fixture(name)) == (OWNER_INFO, TRANSFER_INFO)
+
+
+def test_get_info_returns_lists():
+    table = sdat.ScrapeSDAT.get_table_data(read_fixture('detail.html'), 'detailSearch')
+    assert sdat.ScrapeSDAT.get_owner_info(table) == list(OWNER_INFO)
+    transfer_info = [list(transfer) for transfer in TRANSFER_INFO]
+    assert sdat.ScrapeSDAT.get_transfer_info(table) == transfer_info
+
+
+def test_parse_detail_truncated_page():
+    html = read_fixture('detail.html')
+    truncated = html[:html.index(b'<tr><td>Something else')]
+    assert sdat.parse_detail(truncated) == (OWNER_INFO, TRANSFER_INFO)
+
+
+@pytest.mark.parametrize('html', [
+    b'',
+    b'<html><body><p>Service unavailable</p></body></html>',
+])
+def test_parse_detail_without_detail_table(html):
+    with pytest.raises(ValueError, match='detailSearch table not found'):
+        sdat.parse_detail(html)
+
+
+def test_parse_detail_without_transfer_table():
+    html = read_fixture('detail.html')
+    html = html[:html.index(b'<tr><th>Transfer')] + b'</tbody></table></body></html>'
+    with pytest.raises(ValueError, match='transfer information table not found'):
+        sdat.parse_detail(html)
+
+
+def test_parse_detail_without_owner_header():
+    html = read_fixture('detail.html').replace(b'Owner', b'Property')
+    with pytest.raises(ValueError, match='owner information rows not found'):
+        sdat.parse_detail(html)
+
+
+def test_parse_detail_with_short_owner_row():
+    html = read_fixture('detail.html').replace(b'<tr><td>Owner Name:</td>', b'<tr>')
+    with pytest.raises(ValueError, match='owner information rows not found'):
+        sdat.parse_detail(html)
+
+
+def test_url_cache_evicts_least_recently_used():
+    scraper = sdat.ScrapeSDAT(cache_size=2)
+    scraper._set_cached('https://example.com/?lot=1', 'one')
+    scraper._set_cached('https://example.com/?lot=2', 'two')
+    assert scraper._get_cached('https://example.com/?lot=1') == 'one'
+    scraper._set_cached('https://example.com/?lot=3', 'three')
+    assert scraper._get_cached('https://example.com/?lot=1') == 'one'
+    assert scraper._get_cached('https://example.com/?lot=2') is None
+    assert scraper._get_cached('https://example.com/?lot=3') == 'three'
+
+
+def test_url_cache_drops_expired_entries(monkeypatch):
+    scraper = sdat.ScrapeSDAT(max_age=10)
+    monkeypatch.setattr(sdat.time, 'monotonic', lambda: 100.0)
+    scraper._set_cached('https://example.com/?lot=1', 'one')
+    monkeypatch.setattr(sdat.time, 'monotonic', lambda: 111.0)
+    assert scraper._get_cached('https://example.com/?lot=1') is None
+    assert not scraper._url_cache
+
+
+def test_scrape(server_url):
+    result = sdat.ScrapeSDAT().scrape(f"{server_url}/detail.html")
+    assert result == (OWNER_INFO, TRANSFER_INFO)
+
+
+def test_scrape_error_status(server_url):
+    with pytest.raises(requests.HTTPError):
+        sdat.ScrapeSDAT().scrape(f"{server_url}/error")
+
+
+def test_scrape_many_keeps_other_results_on_failure(server_url):
+    urls = [
+        f"{server_url}/detail.html",
+        f"{server_url}/error",
+        f"{server_url}/detail_nbsp.html",
+    ]
+    results = asyncio.run(sdat.ScrapeSDAT().scrape_many(urls, workers=1))
+    assert results[0] == (OWNER_INFO, TRANSFER_INFO)
+    assert isinstance(results[1], aiohttp.ClientResponseError)
+    assert results[2] == (OWNER_INFO, TRANSFER_INFO)
+
+
+@pytest.mark.parametrize('content_type, charset', [
+    ('text/html; charset=UTF-8', 'utf-8'),
+    ('text/html', None),
+    (None, None),
+])
+def test_header_charset(content_type, charset):
+    assert sdat.header_charset(content_type) == charset
+
+
+def test_scrape_uses_header_charset(server_url):
+    url = f"{server_url}/detail_no_meta_charset.html"
+    owner_info, _ = sdat.ScrapeSDAT().scrape(url)
+    assert owner_info[0] == 'MUÑOZ JOSÉ'
+
+
+def test_scrape_many_uses_header_charset(server_url):
+    urls = [f"{server_url}/detail_no_meta_charset.html"]
+    [(owner_info, _)] = asyncio.run(sdat.ScrapeSDAT().scrape_many(urls, workers=1))
+    assert owner_info[0] == 'MUÑOZ JOSÉ'
+
+
+def test_scrape_many_with_caller_executor(server_url):
+    urls = [f"{server_url}/detail.html"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        results = asyncio.run(sdat.ScrapeSDAT().scrape_many(urls, executor=executor))
+        # the caller's executor is left running
+        assert executor.submit(len, urls).result() == 1
+    assert results == [(OWNER_INFO, TRANSFER_INFO)]
+
+
+def baseline_property_url(search_type, county, ward, section, block, lot):
+    """The URL main() built before the prefix was cached."""
+    query_parameters = {
+        'search_type': search_type,
+        'county': f"{county:02}",
+        'ward': f"{ward:02}",
+        'section': f"{section:02}",
+        'block': f"{block:04}",
+        'lot': f"{lot:03}",
+    }
+    return f"{sdat.BASE_URL}?{urlencode(query_parameters)}"
+
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['--search_type', 'A&B C', '--county', '12', '--lot', '7'],
+])
+def test_build_property_url_matches_urlencode(argv):
+    arguments = vars(sdat.argument_factory().parse_args(argv))
+    assert sdat.build_property_url(**arguments) == baseline_property_url(**arguments)
+
+
+def test_canonical_url_ignores_parameter_order_and_host_case():
+    url = sdat.build_property_url('ACCT', 3, 16, 10, 97, 54)
+    reordered = (
+        "HTTPS://SDAT.dat.Maryland.gov/RealProperty/Pages/viewdetails.aspx"
+        "?lot=054&block=0097&section=10&ward=16&county=03&search_type=ACCT"
+    )
+    assert sdat.canonical_url(reordered) == sdat.canonical_url(url)